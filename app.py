@@ -1,15 +1,15 @@
-import json
 import dash
 from dash import dcc, html, callback_context
 from dash.dependencies import Input, Output, State
-from dash.exceptions import PreventUpdate
-import plotly.express as px
+import plotly.graph_objects as go
+import plotly.io as pio
 from subprocess import Popen
-import os
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from waitress import serve
 from utility_funcs import *
 
-CURRENT_FOLDER = os.path.dirname(os.path.abspath(__file__))
-
+config_data = load_config()  # already read by utility_funcs, so this doesn't touch the disk again
 GRAPH_UNITS = config_data["GRAPH_UNITS"]
 
 COLOURS = {
@@ -19,20 +19,18 @@ COLOURS = {
     "highlighted_bg": "rgb(5, 46, 158)",
 }
 
-with open(os.path.join(CURRENT_FOLDER, "data/config.json"), "r") as f:
-    config_data = json.load(f)
-
-# prevent errors by creating cache files if they don't exist already
-for filename in ["data/currency_cache.json", "data/stock_cache.csv"]:
-    filename = os.path.join(CURRENT_FOLDER, filename)
-    if not os.path.isfile(filename):
-        open(filename, "a").close()
+MAX_GRAPH_POINTS = 2000  # longer series are downsampled before they are sent to the browser
 
 
-PORTFOLIO = load_portfolio()
-TOTAL_VALUE = merge_portfolio(PORTFOLIO)
-# create the dropdown menu
-dropdown_options = [{"label": stock.name, "value": stock.ticker} for stock in PORTFOLIO]
+PORTFOLIO, TOTAL_VALUE = load_portfolio_state()
+# if a ticker appears more than once, the first stock with that ticker is used
+PORTFOLIO_BY_TICKER = {stock.ticker: stock for stock in reversed(PORTFOLIO)}
+LATEST_TOTAL = TOTAL_VALUE.iloc[-1].to_dict()  # most recent row, used by the summary boxes
+# create the dropdown menu, in alphabetical order
+dropdown_options = [
+    {"label": stock.name, "value": stock.ticker}
+    for stock in sorted(PORTFOLIO, key=lambda stock: stock.name)
+]
 
 
 def new_stock_dialog() -> list:
@@ -63,11 +61,53 @@ def new_stock_dialog() -> list:
     form_div_children.append(
         html.P(id="placeholder-div", style={"display": "none"}, children="")
     )  # div to act as a placeholder for callbacks with no output)
+    form_div_children.append(
+        dcc.Store(id="new-stock-form-store")
+    )  # holds the values of all the inputs, in the same order as FIELDS
     return form_div_children
 
 
+def freeze_figure(fig) -> dict:
+    """Serialises `fig` to JSON once, and returns the result as plain lists and dicts.
+    Returning this from a callback avoids Plotly converting the numpy arrays and dates in the figure every time"""
+    return json_loads(pio.to_json(fig, validate=False))
+
+
+def line_trace(data: pd.Series, line_color: str) -> go.Scatter:
+    """Creates a line trace of `data`. This is used rather than px.line, which reshapes the data into a new DataFrame first.
+    Series longer than MAX_GRAPH_POINTS are downsampled, as the graph can't show that many points anyway"""
+    values = data.to_numpy()
+    keep = lttb(data.index.values.astype("datetime64[ns]").view(np.int64), values, MAX_GRAPH_POINTS)
+    return go.Scatter(x=data.index[keep], y=values[keep], mode="lines", line={"color": line_color})
+
+
+# parts of the graph layout shared by the summary and individual graphs
+GRAPH_LAYOUT = {
+    "xaxis_title": "Date",
+    "xaxis": {
+        "rangeselector": {
+            "buttons": [
+                {"count": 1, "label": "1m", "step": "month", "stepmode": "backward"},
+                {"count": 6, "label": "6m", "step": "month", "stepmode": "backward"},
+                {"count": 1, "label": "YTD", "step": "year", "stepmode": "todate"},
+                {"count": 1, "label": "1y", "step": "year", "stepmode": "backward"},
+                {"step": "all"},
+            ],
+            "font": {"color": "black"},
+        },
+        "rangeslider": {"visible": True},
+        "type": "date",
+    },
+    "plot_bgcolor": COLOURS["graph_bg"],
+    "paper_bgcolor": COLOURS["graph_bg"],
+    "font": {"color": "#fff"},
+}
+
+
+@lru_cache(maxsize=2)
 def generate_summary_graph(display_var="percent_change"):
-    """generates graph showing summary info. display_var should be 'percent_change' or 'actual_change'"""
+    """generates graph showing summary info. display_var should be 'percent_change' or 'actual_change'.
+    TOTAL_VALUE doesn't change while the app is running, so each graph is only generated and serialised once"""
 
     data = TOTAL_VALUE[display_var]
     if display_var == "actual_change":
@@ -78,53 +118,24 @@ def generate_summary_graph(display_var="percent_change"):
     if data.iloc[-1] < 0:
         line_color = COLOURS["negative_red"]
 
+    fig = go.Figure(line_trace(data, line_color))
     if display_var == "percent_change":
-        fig = px.line(data, x=data.index, y=display_var)
         title_kw = "Percentage c"
     else:
-        fig = px.line(data, x=data.index, y=display_var)
         title_kw = "C"
 
     layout = {
-        "xaxis_title": "Date",
+        **GRAPH_LAYOUT,
         "yaxis_title": f"{title_kw}hange in portfolio value",
-        "xaxis": {
-            "rangeselector": {
-                "buttons": [
-                    {
-                        "count": 1,
-                        "label": "1m",
-                        "step": "month",
-                        "stepmode": "backward",
-                    },
-                    {
-                        "count": 6,
-                        "label": "6m",
-                        "step": "month",
-                        "stepmode": "backward",
-                    },
-                    {"count": 1, "label": "YTD", "step": "year", "stepmode": "todate"},
-                    {"count": 1, "label": "1y", "step": "year", "stepmode": "backward"},
-                    {"step": "all"},
-                ],
-                "font": {"color": "black"},
-            },
-            "rangeslider": {"visible": True},
-            "type": "date",
-            "gridcolor": line_color,
-        },
+        "xaxis": {**GRAPH_LAYOUT["xaxis"], "gridcolor": line_color},
         "yaxis": {"gridcolor": line_color},
-        "plot_bgcolor": COLOURS["graph_bg"],
-        "paper_bgcolor": COLOURS["graph_bg"],
-        "font": {"color": "#fff"},
     }
 
     if display_var == "actual_value":
         layout["yaxis_title"] = "Net change in portfolio value"
 
     fig.update_layout(layout)
-    fig.update_traces(line_color=line_color)
-    return fig
+    return freeze_figure(fig)
 
 
 def generate_gainers() -> List:
@@ -136,33 +147,25 @@ def generate_gainers() -> List:
         "Smallest Gain (%)",
         f"Smallest Profit ({config_data['BASE_CURRENCY']})",
     ]
-    max_percent_info = (-np.inf, "")  # holds value and name of stock
-    max_profit_info = (-np.inf, "")
-    min_percent_info = (np.inf, "")
-    min_profit_info = (np.inf, "")
-
-    for stock in PORTFOLIO:
-        final_val = stock.data.iloc[-1]["value"]
-        book_cost_per_share = stock.book_cost * 100 / stock.holding
-        total_profit = (final_val - book_cost_per_share) * stock.holding / 100
-        percent_gain = (final_val - book_cost_per_share) * 100 / book_cost_per_share
-
-        if percent_gain > max_percent_info[0]:
-            max_percent_info = (percent_gain, stock.name)
-        if percent_gain < min_percent_info[0]:
-            min_percent_info = (percent_gain, stock.name)
-
-        if total_profit > max_profit_info[0]:
-            max_profit_info = (total_profit, stock.name)
-        if total_profit < min_profit_info[0]:
-            min_profit_info = (total_profit, stock.name)
+    # work out the gain of every stock at once, rather than one stock at a time
+    final_vals = np.array([stock.data["value"].to_numpy()[-1] for stock in PORTFOLIO], dtype=np.float64)
+    book_costs_per_share = np.array([stock.book_cost_per_share for stock in PORTFOLIO])
+    holdings = np.array([stock.holding for stock in PORTFOLIO])
+    names = [stock.name for stock in PORTFOLIO]
+
+    total_profit = (final_vals - book_costs_per_share) * holdings / 100
+    percent_gain = (final_vals - book_costs_per_share) * 100 / book_costs_per_share
 
+    max_percent, min_percent = np.nanargmax(percent_gain), np.nanargmin(percent_gain)
+    max_profit, min_profit = np.nanargmax(total_profit), np.nanargmin(total_profit)
+
+    # holds formatted value and name of stock
     data = [
-        (str(round(i[0], 1)), i[1])
-        for i in [max_percent_info, max_profit_info, min_percent_info, min_profit_info]
+        (f"{percent_gain[max_percent]:.1f}%", names[max_percent]),
+        (f"{total_profit[max_profit]:.1f}", names[max_profit]),
+        (f"{percent_gain[min_percent]:.1f}%", names[min_percent]),
+        (f"{total_profit[min_profit]:.1f}", names[min_profit]),
     ]
-    data[0] = (data[0][0] + "%", data[0][1])
-    data[2] = (data[2][0] + "%", data[2][1])  # add percentage sign to relevant values
 
     for i in range(4):
         children.append(
@@ -179,6 +182,7 @@ def generate_gainers() -> List:
 
 
 app = dash.Dash(__name__)
+server = app.server  # for WSGI servers, e.g. `gunicorn --preload app:server`
 app.layout = html.Div(
     id="wrapper",
     className="wrapper",
@@ -210,7 +214,14 @@ app.layout = html.Div(
                 dcc.Graph(
                     id="summary-chart",
                     className="summary-chart",
-                    figure=generate_summary_graph(),
+                ),
+                # both summary figures are sent once, so switching between them doesn't need the server
+                dcc.Store(
+                    id="summary-figures",
+                    data={
+                        display_var: generate_summary_graph(display_var)
+                        for display_var in ["percent_change", "actual_change"]
+                    },
                 ),
                 html.Div(
                     className="summary-content-wrapper",
@@ -224,10 +235,7 @@ app.layout = html.Div(
                                 ),
                                 html.Div(
                                     className="summary-content",
-                                    children="£"
-                                    + str(
-                                        round(TOTAL_VALUE.iloc[-1]["value"] / 100, 2)
-                                    ),
+                                    children=f"£{LATEST_TOTAL['value'] / 100:,.2f}",
                                 ),
                             ],
                         ),
@@ -240,12 +248,7 @@ app.layout = html.Div(
                                 ),
                                 html.Div(
                                     className="summary-content",
-                                    children="£"
-                                    + str(
-                                        round(
-                                            TOTAL_VALUE.iloc[-1]["book_cost"] / 100, 2
-                                        )
-                                    ),
+                                    children=f"£{LATEST_TOTAL['book_cost'] / 100:,.2f}",
                                 ),
                             ],
                         ),
@@ -260,10 +263,7 @@ app.layout = html.Div(
                                 ),
                                 html.Div(
                                     className="summary-content",
-                                    children=str(
-                                        round(TOTAL_VALUE.iloc[-1]["percent_change"], 2)
-                                    )
-                                    + "%",
+                                    children=f"{LATEST_TOTAL['percent_change']:.2f}%",
                                 ),
                             ],
                         ),
@@ -278,13 +278,7 @@ app.layout = html.Div(
                                 ),
                                 html.Div(
                                     className="summary-content",
-                                    children="£"
-                                    + str(
-                                        round(
-                                            TOTAL_VALUE.iloc[-1]["actual_change"] / 100,
-                                            2,
-                                        )
-                                    ),
+                                    children=f"£{LATEST_TOTAL['actual_change'] / 100:,.2f}",
                                 ),
                             ],
                         ),
@@ -303,7 +297,7 @@ app.layout = html.Div(
                         dcc.Dropdown(
                             id="ticker_dropdown",
                             options=dropdown_options,
-                            value=dropdown_options[0]["value"],
+                            value=PORTFOLIO[0].ticker,
                             clearable=False,
                         ),
                         html.Div(id="title-div", className="title-div"),
@@ -390,76 +384,80 @@ app.layout = html.Div(
 )
 
 
-@app.callback(
-    [Output("add-stock-form", "style")],
-    [Input("add-stock-button", "n_clicks"), Input("stock-dialog-submit", "n_clicks")],
+# a single worker, so that new stocks are written to the portfolio file one at a time
+PORTFOLIO_WRITER = ThreadPoolExecutor(max_workers=1)
+
+
+def report_portfolio_write(future):
+    """Prints the error if writing a new stock failed, as the executor would otherwise discard it silently"""
+    if future.exception() is not None:
+        print(f"Adding new stock has failed. Error message: \n{future.exception()}")
+
+
+# collect the form inputs into one store in the browser, so the server callback only needs a single State
+app.clientside_callback(
+    "function(...values) { return values; }",
+    Output("new-stock-form-store", "data"),
     [
-        State(f"new-stock-dialog-{id.lower().replace(' ', '-')}", "value")
+        Input(f"new-stock-dialog-{id.lower().replace(' ', '-')}", "value")
         for id in FIELDS
     ],
 )
-def show_stock_form(show_button_clicks, submit_button_clicks, *input_data):
-    """If "add new stock" button is clicked, change the visibility of the form
-    if there is an odd number of clicks, show the form, otherwise hide it"""
-
-    changed_id = [p["prop_id"] for p in callback_context.triggered][0]
-    if show_button_clicks == None:
-        raise PreventUpdate
-    if "add-stock-button" in changed_id:
-        if show_button_clicks % 2:
-            return [{"display": "block"}]
-        else:
-            return [{"display": "none"}]
-    else:
-        add_new_stock_to_file(input_data)
-        return [{"display": "none"}]
 
 
-# @app.callback(
-#     [Output("add-stock-form", "style")],
-#     [Input("stock-dialog-submit", "n_clicks")],
-#     [
-#         State(f"new-stock-dialog-{id.lower().replace(' ', '-')}", "value")
-#         for id in FIELDS
-#     ],
-# )
-# def add_new_stock(button_clicks, *input_data):
-#     if button_clicks == None:
-#         raise PreventUpdate
-#     else:
-#         print("here")
-#         add_new_stock_to_file(input_data)
+@app.callback(
+    Output("add-stock-form", "style"),
+    [Input("add-stock-button", "n_clicks"), Input("placeholder-div", "children")],
+    State("add-stock-form", "style"),
+    prevent_initial_call=True,
+)
+def show_stock_form(show_button_clicks, submitted, style):
+    """If "add new stock" button is clicked, change the visibility of the form.
+    The form is always hidden once a new stock has been submitted"""
 
-#     return [{"display": "none"}]
+    changed_id = [p["prop_id"] for p in callback_context.triggered][0]
+    if "add-stock-button" in changed_id and (style or {}).get("display") != "block":
+        return {"display": "block"}
+    return {"display": "none"}
 
 
 @app.callback(
+    Output("placeholder-div", "children"),
+    Input("stock-dialog-submit", "n_clicks"),
+    State("new-stock-form-store", "data"),
+    prevent_initial_call=True,
+)
+def add_new_stock(submit_button_clicks, input_data):
+    """Saves the stock entered in the form to the portfolio file.
+    The file is written in the background, so the form closes straight away"""
+    PORTFOLIO_WRITER.submit(add_new_stock_to_file, input_data).add_done_callback(report_portfolio_write)
+    # a different value each time, so that show_stock_form always hides the form
+    return str(submit_button_clicks)
+
+
+# updates graph data and style of percent change and actual change divs in summary section when either one is clicked.
+# the clicked div becomes a lighter blue, and the unclicked one returns to the original darker blue
+app.clientside_callback(
+    """
+    function(percentClicks, actualClicks, figures) {
+        const changedId = dash_clientside.callback_context.triggered.map((t) => t.prop_id).join();
+        const actual = changedId.includes("actual-change-box");
+        return [
+            figures[actual ? "actual_change" : "percent_change"],
+            {"background-color": actual ? "%(graph_bg)s" : "%(highlighted_bg)s"},
+            {"background-color": actual ? "%(highlighted_bg)s" : "%(graph_bg)s"},
+        ];
+    }
+    """
+    % COLOURS,
     [
         Output("summary-chart", "figure"),
         Output("percent-change-box", "style"),
         Output("actual-change-box", "style"),
     ],
     [Input("percent-change-box", "n_clicks"), Input("actual-change-box", "n_clicks")],
+    State("summary-figures", "data"),
 )
-def update_summary_graph(percent_new_clicks: int, actual_new_clicks: int) -> px.line:
-    """updates graph data and style of percent change and actual change divs in summary section when either one is clicked.
-    the clicked div becomes a lighter blue, and the unclicked one returns to the original darker blue"""
-    changed_id = [p["prop_id"] for p in callback_context.triggered][0]
-
-    if percent_new_clicks == None:
-        raise PreventUpdate
-    elif "actual-change-box" in changed_id:
-        return [
-            generate_summary_graph("actual_change"),
-            {"background-color": COLOURS["graph_bg"]},
-            {"background-color": COLOURS["highlighted_bg"]},
-        ]
-    else:
-        return [
-            generate_summary_graph("percent_change"),
-            {"background-color": COLOURS["highlighted_bg"]},
-            {"background-color": COLOURS["graph_bg"]},
-        ]
 
 
 @app.callback(
@@ -473,18 +471,17 @@ def update_summary_graph(percent_new_clicks: int, actual_new_clicks: int) -> px.
     ],
     [Input("ticker_dropdown", "value")],
 )
-def update_graph(ticker: str) -> list:
+def update_graph(ticker: str) -> tuple:
     """updates bottom graph and data boxes below it"""
+    return build_individual_response(ticker)
 
-    data = TOTAL_VALUE
-    line_color = COLOURS["positive_green"]
 
-    layout = {
-        "xaxis_title": "Date",
-        "plot_bgcolor": COLOURS["graph_bg"],
-        "paper_bgcolor": COLOURS["graph_bg"],
-        "font": {"color": "#fff"},
-    }
+@lru_cache(maxsize=None)
+def build_individual_response(ticker: str) -> tuple:
+    """builds the contents of the data boxes, the title and the figure shown in the individual section for `ticker`.
+    PORTFOLIO doesn't change while the app is running, so each ticker is only built the first time it is shown"""
+
+    line_color = COLOURS["positive_green"]
 
     response = {
         "value": None,
@@ -493,57 +490,46 @@ def update_graph(ticker: str) -> list:
         "min": None,
     }
 
-    for stock in PORTFOLIO:
-        if stock.ticker == ticker:
-            data = stock.data["value"].fillna(method="ffill").dropna()
-            book_cost_per_share = stock.book_cost * 100 / stock.holding
-            book_cost = stock.book_cost
-            name = stock.name
-            holding = stock.holding
-            break
-
-    response["value"] = str(round(data.iloc[-1] * holding / 100 - book_cost, 1))
-    response["gain"] = (
-        str(round((data.iloc[-1] - book_cost_per_share) * 100 / book_cost_per_share, 1))
-        + "%"
-    )
-    response["max"] = str(round(data.max() * holding / 100 - book_cost, 1))
-    response["min"] = str(round(data.min() * holding / 100 - book_cost, 1))
-
-    if data.iloc[-1] < data.iloc[0]:
+    stock = PORTFOLIO_BY_TICKER[ticker]
+    data = stock.value_series
+    book_cost_per_share = stock.book_cost_per_share
+    book_cost = stock.book_cost
+    name = stock.name
+    holding = stock.holding
+
+    # read the values once as a NumPy array rather than indexing the Series repeatedly
+    values = data.to_numpy()
+    last, highest, lowest = values[-1], values.max(), values.min()
+
+    response["value"] = f"{last * holding / 100 - book_cost:.1f}"
+    response["gain"] = f"{(last - book_cost_per_share) * 100 / book_cost_per_share:.1f}%"
+    response["max"] = f"{highest * holding / 100 - book_cost:.1f}"
+    response["min"] = f"{lowest * holding / 100 - book_cost:.1f}"
+
+    if last < values[0]:
         line_color = COLOURS["negative_red"]
-    fig = px.line(data, x=data.index, y="value")
+    fig = go.Figure(line_trace(data, line_color))
 
-    layout["yaxis_title"] = f"Value of {ticker} ({GRAPH_UNITS})"
     title = f"Value of {name}"
 
-    fig.update_traces(line_color=line_color)
-
-    layout["xaxis"] = {
-        "rangeselector": {
-            "buttons": [
-                {"count": 1, "label": "1m", "step": "month", "stepmode": "backward"},
-                {"count": 6, "label": "6m", "step": "month", "stepmode": "backward"},
-                {"count": 1, "label": "YTD", "step": "year", "stepmode": "todate"},
-                {"count": 1, "label": "1y", "step": "year", "stepmode": "backward"},
-                {"step": "all"},
-            ],
-            "font": {"color": "black"},
-        },
-        "rangeslider": {"visible": True},
-        "type": "date",
-        "gridcolor": line_color,
+    layout = {
+        **GRAPH_LAYOUT,
+        "yaxis_title": f"Value of {ticker} ({GRAPH_UNITS})",
+        "xaxis": {**GRAPH_LAYOUT["xaxis"], "gridcolor": line_color},
+        "yaxis": {"gridcolor": line_color},
     }
-
-    layout["yaxis"] = {"gridcolor": line_color}
     fig.update_layout(layout)
-    return *[str(i) for i in response.values()], title, fig
+    return *response.values(), title, freeze_figure(fig)
 
 
-if config_data["AUTO_OPEN_BROWSER"]:
-    Popen([config_data["BROWSER_PATH"], "http://127.0.0.1:8050"])
+if __name__ == "__main__":
+    if config_data["AUTO_OPEN_BROWSER"]:
+        Popen([config_data["BROWSER_PATH"], "http://127.0.0.1:8050"])
 
-# uncomment to run locally
-app.run_server(
-    debug=config_data["DEBUG"], host="0.0.0.0", port="8050", dev_tools_hot_reload=False
-)
+    if config_data["DEBUG"]:
+        app.run_server(
+            debug=True, host="0.0.0.0", port="8050", dev_tools_hot_reload=False
+        )
+    else:
+        # the Flask development server handles one request at a time, so use waitress instead
+        serve(app.server, host="0.0.0.0", port=8050, threads=8)
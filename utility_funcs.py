@@ -1,14 +1,38 @@
 import numpy as np
 import pandas as pd
-from dataclasses import dataclass
+import pyarrow.parquet as pq
+from dataclasses import dataclass, field
 import datetime as dt
-from typing import List
+from typing import List, Tuple
+from functools import lru_cache, cached_property
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from yahoo_fin import stock_info as si
-from functools import reduce
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import hashlib
+import pickle
+import atexit
+import glob
 import os
 import sys
+import time
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    # orjson is much faster, but fall back to the standard library if it isn't installed
+    import json
+
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
 
 if __name__ == "__main__":
     print("Run app.py instead")
@@ -32,24 +56,77 @@ FIELDS = [
 ]  # JSON fields for each stock
 
 files = [
-    "data/currency_cache.json",
+    "data/currency_cache",
     "data/config.json",
     "data/portfolio.json",
+    "data/stock_cache.parquet",
+    "data/stock_cache_incremental",
     "data/stock_cache.csv",
+    "data/currency_cache.json",
+    "data/state.pkl",
+    "data/stock_cache_export.csv",
 ]  # relevant file names
-[CURRENCY_CACHE_FILE, CONFIG_FILE, PORTFOLIO_FILE, STOCK_CACHE_FILE] = [
+[
+    CURRENCY_CACHE_FOLDER,
+    CONFIG_FILE,
+    PORTFOLIO_FILE,
+    STOCK_CACHE_FILE,
+    STOCK_CACHE_INCREMENT_FOLDER,
+    LEGACY_STOCK_CACHE_FILE,
+    LEGACY_CURRENCY_CACHE_FILE,
+    STATE_FILE,
+    STOCK_CACHE_EXPORT_FILE,
+] = [
     os.path.join(CURRENT_FOLDER, x) for x in files
 ]  # get corrent path to files
 
-with open(CURRENCY_CACHE_FILE, "r") as f:
-    CURRENCY_DATA = json.load(f)
+# exchange rates are cached in one file per currency, each only read when that currency is first needed
+CURRENCY_DATA = {}
+_DIRTY_CURRENCIES = set()  # currencies whose rates have changed since they were last written to disk
+_CURRENCY_LOCK = threading.Lock()  # stocks are loaded in parallel, so guard changes to CURRENCY_DATA
+_FETCH_LOCKS = {}  # one lock per currency, held while its missing rates are downloaded
+
+if not glob.glob(os.path.join(CURRENCY_CACHE_FOLDER, "*.json")):
+    # split the old single cache file up. The new files are written by flush_currency_cache
+    try:
+        with open(LEGACY_CURRENCY_CACHE_FILE, "rb") as f:
+            CURRENCY_DATA = json_loads(f.read())
+        _DIRTY_CURRENCIES.update(CURRENCY_DATA)
+    except (FileNotFoundError, ValueError):
+        # nothing cached yet (older versions created the cache as an empty file)
+        pass
+
+# one session for all exchange rate and Yahoo Finance requests, so connections are reused between calls
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.3)),
+)
 
-with open(CONFIG_FILE, "r") as f:
-    config_data = json.load(f)
+
+@lru_cache(maxsize=1)
+def _read_config(mtime_ns: int) -> dict:
+    """Reads the config file. `mtime_ns` is only used as the cache key"""
+    with open(CONFIG_FILE, "rb") as f:
+        return json_loads(f.read())
+
+
+def load_config() -> dict:
+    """Returns the contents of the config file. The file is only read again if it has been modified"""
+    return _read_config(os.stat(CONFIG_FILE).st_mtime_ns)
+
+
+config_data = load_config()
 
 BASE_CURRENCY = config_data["BASE_CURRENCY"]
 VERBOSE = config_data["VERBOSE"]
 
+# new stock data is appended to the cache as separate files, which are merged into the main file once there are this many
+MAX_STOCK_CACHE_INCREMENTS = 30
+
+# in debug mode, the saved portfolio state is reused for this many seconds, long enough to cover the reloader's restart
+STATE_TTL = 60
+
 
 @dataclass
 class Stock:
@@ -65,11 +142,16 @@ class Stock:
     commission: float
     fx_charge: float
     exchange: str # either LSE, NASDAQ or CRYPTO
-    date_sold: dt.datetime = dt.date.today()
+    date_sold: dt.datetime = field(default_factory=dt.date.today)
     data: pd.DataFrame = None
     gained: bool = False
+    book_cost_per_share: float = field(init=False, repr=False)  # in pence
+    _new_rows: pd.DataFrame = field(default=None, init=False, repr=False)  # data not yet in the cache
+    daily: pd.Series = field(default=None, init=False, repr=False)  # mean value of the holding for each day
 
     def __post_init__(self):
+        self.book_cost_per_share = self.book_cost * 100 / self.holding
+
         if self.data is None:
             # no data for this stock was present in cache, so fetch new data
 
@@ -80,27 +162,24 @@ class Stock:
                 self.ticker,
                 exchange=self.exchange,
             )
-            # apply currency conversion (if required):
+            # apply currency conversion (if required). Prices in the base currency are left as they are, as Yahoo
+            # already quotes LSE stocks in pence, whereas _convert_currency converts whole units of other currencies
             if self.currency != BASE_CURRENCY:
-                self.data["value"] = self.data.apply(
-                    lambda row: convert_currency(
-                        row["value"], row["time"], self.currency
-                    )
-                    * 100,
-                    axis=1,
-                )
+                self.data["value"] = self._convert_currency(self.data)
 
             # apply commission/fx charge using book price
-            self.data.loc[(self.data.index[0], "value")] = (
-                self.book_cost * 100 / self.holding
-            )  # equivalent to self.data.iloc[0]["value"], but prevents SettingWithCopyWarning
+            self.data.iat[0, self.data.columns.get_loc("value")] = (
+                self.book_cost_per_share
+            )  # positional, so it only sets the first row even if its time is repeated
             if VERBOSE: print(self.data)
+            self._new_rows = self.data
 
         else:
             # data was cached, but is not fully up to date
             last_date = self.data.index[-1].date()
             # to avoid confusion/out of date data, remove all data generated on this date
-            self.data = self.data[self.data["time"].dt.date != last_date]
+            days = self.data.index.values.astype("datetime64[D]")
+            self.data = self.data[days != np.datetime64(last_date, "D")]
 
             new_data = get_values(
                 last_date,
@@ -108,84 +187,243 @@ class Stock:
                 self.ticker,
                 exchange=self.exchange,
             )
-            new_data.drop_duplicates(inplace=True)
-            if self.currency != BASE_CURRENCY:
-                new_data["value"] = new_data.apply(
-                    lambda row: convert_currency(
-                        row["value"], row["time"], self.currency
-                    )
-                    * 100,
-                    axis=1,
-                )
+            # rows are only duplicated if they have the same time, which is the index
+            new_data = new_data[~new_data.index.duplicated()]
+            if self.currency != BASE_CURRENCY:  # see above for why base currency prices aren't scaled
+                new_data["value"] = self._convert_currency(new_data)
 
             self.data = pd.concat([self.data, new_data])
+            self._new_rows = new_data
+
+        # prices only need ~7 significant figures, so float32 halves the memory used without losing anything
+        self.data["value"] = self.data["value"].astype(np.float32)
+
+        # work out the daily values now, so that merge_portfolio doesn't need to
+        days, means = _daily_mean(
+            ffill_float(self.data["value"].to_numpy()),
+            self.data.index.values,
+        )
+        self.daily = pd.Series(means * self.holding, index=days)
+
+    @cached_property
+    def value_series(self) -> pd.Series:
+        """The `value` column of `data`, forward filled and without any leading NaNs"""
+        values = self.data["value"].to_numpy(dtype=np.float64)
+        valid = ~np.isnan(values)
+        # after forward filling, the only NaNs left are before the first valid value
+        first_valid = valid.argmax() if valid.any() else values.size
+        return pd.Series(
+            ffill_float(values)[first_valid:], index=self.data.index[first_valid:], name="value"
+        )
+
+    def _convert_currency(self, data: pd.DataFrame) -> np.ndarray:
+        """Returns the `value` column of `data` converted to the base currency (in pence),
+        using one exchange rate per day"""
+        # look rates up once per day, then map them back to the rows by position, so only the days are formatted
+        # as the YYYY-MM-DD strings the currency cache is keyed by
+        days, day_ids = np.unique(data.index.values.astype("datetime64[D]"), return_inverse=True)
+        rates = _fx_rates_for_dates(self.currency, np.datetime_as_string(days)).to_numpy()
+        # if a rate isn't available for a day (e.g. today's hasn't been published yet), use the previous day's
+        return data["value"].to_numpy() * ffill_float(rates)[day_ids] * 100.0
 
 
 def load_portfolio(file: str = PORTFOLIO_FILE) -> List[Stock]:
     """return is a list of Stock objects. Each Stock contains all the information about the stock from the json,
     plus a dataframe showing prices between start date and end date"""
-    with open(file, "r") as f:
-        stock_list = json.load(f)
+    with open(file, "rb") as f:
+        stock_list = json_loads(f.read())
 
     # load in cached data
-    try:
-        imported_data = pd.read_csv(STOCK_CACHE_FILE)
-        imported_data["time"] = pd.to_datetime(imported_data["time"])
-    except pd.errors.EmptyDataError:
-        # handle case where no data in file
-        imported_data = pd.DataFrame(columns=["time", *stock_list])
-
-    rep = []
-    # create stock objects
+    imported_data = read_stock_cache([stock["name"] for stock in stock_list]).set_index("time")
 
     for stock in stock_list:
         name = stock["name"]
 
         # check if stock has any data cached, and if it does, assign it to the new stock
-        if name in list(imported_data.columns):
-            stock["data"] = imported_data[["time", name]].fillna(method="ffill")
-            stock["data"].columns = ["time", "value"]
-
-            stock["data"].index = stock["data"]["time"]
-
-        new_stock = Stock(**stock)
-        rep.append(new_stock)
-
-    # once all stocks have been created and __post_init__() has run, save to cache
-
-    # create a list of all the dataframes
-    dataframes: List[pd.DataFrame] = [
-        stock.data.drop("time", axis=1).drop(stock.data.index[-1]) for stock in rep
-    ]
+        if name in imported_data.columns:
+            stock["data"] = pd.DataFrame(
+                {"value": ffill_float(imported_data[name].to_numpy())}, index=imported_data.index
+            )
 
-    # to concaternate, we require that all arrays have the same index. Therefore, we need to fill any missing index values with NaN
-    all_timestamps = np.unique(np.concatenate([df.index.values for df in dataframes]))
-    for i, df in enumerate(dataframes):
+    # create stock objects. Each one may need to download data, so create them in parallel
+    with ThreadPoolExecutor(max_workers=min(16, max(len(stock_list), 1))) as executor:
+        rep: List[Stock] = list(executor.map(lambda stock: Stock(**stock), stock_list))
 
-        missing_indices = np.setdiff1d(all_timestamps, df.index.values)
-        nan_rows = pd.DataFrame(
-            {"value": np.empty(len(missing_indices)).fill(np.nan)},
-            index=missing_indices,
-            dtype=np.float64,
-        )
-        dataframes[i] = pd.concat([df, nan_rows]).sort_index()
+    # once all stocks have been created and __post_init__() has run, save the newly fetched data to cache
 
-    # last row in each df is dropped as this is a real-time value and may not be applicable in future
     try:
+        # create a list of all the dataframes
+        # last row in each df is dropped as this is a real-time value and may not be applicable in future.
+        # times can repeat (e.g. a CRYPTO close is at the same time as the next day's open), so keep the first
+        dataframes: List[pd.DataFrame] = []
+        for stock in rep:
+            df = stock._new_rows.iloc[:-1]
+            dataframes.append(df[~df.index.duplicated()])
+
+        # to concaternate, we require that all arrays have the same index. Therefore, we need to fill any missing index values with NaN
+        all_timestamps = pd.Index(np.unique(np.concatenate([df.index.values for df in dataframes])))
         to_cache = pd.concat(
-            dataframes,
+            [df.reindex(all_timestamps) for df in dataframes],
             axis=1,
         )
 
         to_cache.columns = [stock.name for stock in rep]
-        to_cache.to_csv(STOCK_CACHE_FILE, index_label="time")
+        # only the new rows are written, to a new file, rather than rewriting the whole cache
+        os.makedirs(STOCK_CACHE_INCREMENT_FOLDER, exist_ok=True)
+        _write_stock_cache(
+            to_cache,
+            os.path.join(
+                STOCK_CACHE_INCREMENT_FOLDER, f"{dt.datetime.now():%Y%m%d%H%M%S%f}.parquet"
+            ),
+        )
+        _compact_stock_cache()
+        if config_data.get("EXPORT_STOCK_CACHE_CSV", False):
+            # the cache is stored as parquet, so optionally keep a CSV copy of it for other tools
+            read_stock_cache().to_csv(STOCK_CACHE_EXPORT_FILE, index=False, float_format="%.4f")
     except Exception as e:
         # for some reason this is usually a temporary problem that seems to sort itself out when code is run a few days later
         print(f"Caching has failed. Error message: \n{e}")
 
+    flush_currency_cache()
+
     return rep
 
 
+@lru_cache(maxsize=128)
+def _get_raw_data(ticker: str, start: dt.datetime, end: dt.datetime) -> pd.DataFrame:
+    """Returns the open and close prices of `ticker` between `start` and `end` from Yahoo Finance.
+    Results are memoised, and ranges that finish before today are also saved to disk as they will not change.
+    The returned DataFrame is shared between calls, so should not be modified"""
+    path = os.path.join(
+        CURRENT_FOLDER, f"data/yf_{ticker}_{start:%Y-%m-%d}_{end:%Y-%m-%d}.parquet"
+    )
+    if os.path.isfile(path):
+        try:
+            return pd.read_parquet(path, engine="pyarrow")
+        except (OSError, ValueError) as e:
+            # a damaged file is fetched again, and replaced below
+            print(f"Reading {path} has failed, so it will be downloaded again. Error message: \n{e}")
+
+    try:
+        try:
+            raw = _fetch_yahoo(ticker, start, end + dt.timedelta(days=1))
+        except (requests.RequestException, ValueError):
+            # fall back to yahoo_fin if the chart API can't be reached or its response can't be read
+            raw = si.get_data(
+                ticker,
+                start.strftime("%m/%d/%y"),
+                (end + dt.timedelta(days=1)).strftime("%m/%d/%y"),
+            )[["open", "close"]]
+    except KeyError:
+        # some wierd quirk with the yahoo_fin module
+        index = pd.date_range(start, end, freq="1D")
+        return pd.DataFrame(np.nan, columns=["open", "close"], index=index)
+
+    if pd.Timestamp(end).normalize() < pd.Timestamp.today().normalize():
+        # written under a temporary name first, so a crash part way through can't leave a truncated file
+        raw.to_parquet(f"{path}.tmp", engine="pyarrow")
+        os.replace(f"{path}.tmp", path)
+    return raw
+
+
+def _fetch_yahoo(ticker: str, start: dt.datetime, end: dt.datetime) -> pd.DataFrame:
+    """Returns the daily open and close prices of `ticker` from `start` up to (not including) `end`,
+    read straight from Yahoo Finance's JSON chart API. The index matches `si.get_data`"""
+    response = _SESSION.get(
+        f"https://query1.finance.yahoo.com/v8/finance/chart/{ticker}",
+        params={
+            "period1": int(pd.Timestamp(start).timestamp()),
+            "period2": int(pd.Timestamp(end).timestamp()),
+            "interval": "1d",
+        },
+        headers={"User-Agent": "Mozilla/5.0"},  # requests without a user agent are rejected
+        timeout=10,
+    )
+    if not response.ok:
+        # same as yahoo_fin, so get_values can report unknown tickers
+        raise AssertionError(response.json())
+
+    result = response.json()["chart"]["result"][0]
+    quote = result["indicators"]["quote"][0]
+    # missing prices are null in the JSON, which become NaN here
+    return pd.DataFrame(
+        {
+            "open": np.array(quote["open"], dtype=np.float64),
+            "close": np.array(quote["close"], dtype=np.float64),
+        },
+        index=pd.to_datetime(result["timestamp"], unit="s").floor("D"),
+    )
+
+
+def read_stock_cache(names: List[str] = None) -> pd.DataFrame:
+    """Returns the `time` column and the cached values of any of the stocks in `names` (or every stock, if `names` is None).
+    The main cache file and all incremental files are combined, with newer files taking priority.
+    If there is no parquet cache yet, the old CSV cache is read and converted"""
+    paths = _stock_cache_files()
+    if not paths:
+        try:
+            imported_data = pd.read_csv(LEGACY_STOCK_CACHE_FILE, parse_dates=["time"])
+        except (FileNotFoundError, pd.errors.EmptyDataError):
+            # handle case where no data has been cached
+            return pd.DataFrame(columns=["time"])
+        # only new data is written to the cache from now on, so the existing data must be converted now
+        _write_stock_cache(imported_data.set_index("time"), STOCK_CACHE_FILE)
+        paths = [STOCK_CACHE_FILE]
+
+    frames = []
+    for path in paths:
+        try:
+            # only read the columns for stocks that are still in the portfolio
+            columns = [
+                column
+                for column in pq.read_schema(path).names
+                if column != "time" and (names is None or column in names)
+            ]
+            frames.append(
+                pd.read_parquet(path, engine="pyarrow", columns=["time", *columns])
+            )
+        except (OSError, ValueError) as e:
+            # a damaged file is treated as missing, so its data is fetched again and rewritten
+            print(f"Reading {path} from the stock cache has failed, so it will be removed. Error message: \n{e}")
+            os.remove(path)
+
+    if not frames:
+        return pd.DataFrame(columns=["time"])
+    if len(frames) == 1:
+        return frames[0]
+    # last() takes the most recent non-NaN value of each stock at each time
+    return pd.concat(frames).groupby("time").last().reset_index()
+
+
+def _stock_cache_files() -> List[str]:
+    """Returns the paths of the main stock cache file and the incremental cache files, oldest first"""
+    paths = sorted(glob.glob(os.path.join(STOCK_CACHE_INCREMENT_FOLDER, "*.parquet")))
+    if os.path.isfile(STOCK_CACHE_FILE):
+        paths.insert(0, STOCK_CACHE_FILE)
+    return paths
+
+
+def _write_stock_cache(data: pd.DataFrame, path: str):
+    """Writes `data` (indexed by time, with one column per stock) to the parquet file at `path`.
+    The file is written under a temporary name first, so a crash part way through can't leave a truncated cache"""
+    # prices are only displayed to 1dp, so float32 is precise enough and halves the file size
+    data.astype(np.float32).rename_axis("time").reset_index().to_parquet(
+        f"{path}.tmp", engine="pyarrow", compression="zstd", index=False
+    )
+    os.replace(f"{path}.tmp", path)
+
+
+def _compact_stock_cache():
+    """Merges the incremental stock cache files into the main cache file, once there are enough of them"""
+    increments = glob.glob(os.path.join(STOCK_CACHE_INCREMENT_FOLDER, "*.parquet"))
+    if len(increments) < MAX_STOCK_CACHE_INCREMENTS:
+        return
+
+    _write_stock_cache(read_stock_cache().set_index("time"), STOCK_CACHE_FILE)
+    for path in increments:
+        os.remove(path)
+
+
 def get_values(
     start: dt.datetime, end: dt.datetime, ticker: str, exchange: str = "LSE"
 ) -> pd.DataFrame:
@@ -196,80 +434,283 @@ def get_values(
     if VERBOSE: print("Fetching data:")
     try:
         if VERBOSE: print(ticker)
-        raw = si.get_data(
-            ticker,
-            start.strftime("%m/%d/%y"),
-            (end + dt.timedelta(days=1)).strftime("%m/%d/%y"),
-        )[["open", "close"]]
-    except KeyError:
-        # some wierd quirk with the yahoo_fin module
-        index = pd.date_range(start, end, freq="1D")
-        raw = pd.DataFrame(np.nan, columns=["open", "close"], index=index)
+        raw = _get_raw_data(ticker, start, end)
     except AssertionError as e:
         print("Assertion error. Ticker likely does not exist")
         print(e)
         raise AssertionError
 
 
-    # turn into data frame with one column (value) and forward fill any missing values
-    rep = pd.concat([raw["open"], raw["close"]]).to_frame().fillna(method="ffill")
-    rep.columns = ["value"]
+    # interleave the open and close values and times, so that they are already in time order
+    dates = raw.index.values.astype("datetime64[ns]")
+    values = np.empty(2 * dates.size)
+    values[0::2] = raw["open"].to_numpy()
+    values[1::2] = raw["close"].to_numpy()
+    timestamps = np.empty(2 * dates.size, dtype="datetime64[ns]")
+    timestamps[0::2] = dates + np.timedelta64(times["open"], "h")
+    timestamps[1::2] = dates + np.timedelta64(times["close"], "h")
 
-    # add open and close times to index, and return sorted dataframe
-    rep.index = pd.concat(
-        [
-            raw.index.to_series() + dt.timedelta(hours=times["open"]),
-            raw.index.to_series() + dt.timedelta(hours=times["close"]),
-        ]
-    )
-    rep: pd.DataFrame = rep.rename(index={rep.index[-1]: dt.datetime.now()})
-    if rep.index[-1] < rep.index[-2]:
-        rep.drop(rep.index[-1], inplace=True)
+    # the last value is the current price
+    timestamps[-1] = np.datetime64(dt.datetime.now(), "ns")
+    if timestamps[-1] < timestamps[-2]:
+        values, timestamps = values[:-1], timestamps[:-1]
+
+    # forward fill any missing values
+    values = ffill_float(values)
 
     # crypto assets need their currency converted to pence
     if exchange == "CRYPTO":
-        rep["value"] = rep["value"] * 100.0
-    return rep.sort_index().assign(time=rep.index.values)
+        values = values * 100.0
+    return pd.DataFrame({"value": values}, index=pd.DatetimeIndex(timestamps, name="time"))
+
+
+def ffill_float(values: np.ndarray) -> np.ndarray:
+    """Returns a copy of `values` with each NaN replaced by the last non-NaN value before it"""
+    last_valid = np.where(np.isnan(values), 0, np.arange(values.size))
+    np.maximum.accumulate(last_valid, out=last_valid)
+    return values[last_valid]
+
+
+def _daily_mean(values: np.ndarray, times: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the days that `times` fall on, and the mean of `values` for each of those days (ignoring NaNs)"""
+    days, day_ids = np.unique(times.astype("datetime64[D]"), return_inverse=True)
+    present = ~np.isnan(values)
+
+    sums = np.bincount(day_ids, weights=np.where(present, values, 0.0), minlength=days.size)
+    counts = np.bincount(day_ids, weights=present, minlength=days.size)
+    with np.errstate(invalid="ignore"):
+        # days with no values are 0/0, so become NaN as they would with groupby().mean()
+        return days, sums / counts
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Returns the indices of `n_out` points of the line (x, y) chosen with the Largest-Triangle-Three-Buckets
+    algorithm, which keeps the shape of the line while leaving out most of its points. `x` must be sorted
+
+    The first and last points are always kept, the indices are strictly increasing, and a line that already has
+    `n_out` points or fewer is returned whole:
+
+    >>> x = np.arange(1000)
+    >>> idx = lttb(x, np.sin(x / 50.0), 100)
+    >>> idx.size, int(idx[0]), int(idx[-1]), bool((np.diff(idx) > 0).all())
+    (100, 0, 999, True)
+    >>> lttb(x[:50], np.sin(x[:50] / 50.0), 100).tolist() == list(range(50))
+    True
+    """
+    n = y.size
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    x = x.astype(np.float64) - x[0]
+
+    # the first and last points are always kept, and one point is picked from each bucket in between
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+
+    a = 0  # the previously selected point
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # the third point of the triangle is the average of the next bucket
+        if i + 2 < edges.size:
+            next_x, next_y = x[end : edges[i + 2]], y[end : edges[i + 2]]
+            next_y = next_y[~np.isnan(next_y)]
+            cx, cy = next_x.mean(), next_y.mean() if next_y.size else y[a]
+        else:
+            cx, cy = x[-1], y[-1]
+
+        area = np.abs((x[a] - cx) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (cy - y[a]))
+        # points that can't be measured (NaN) are only picked if the whole bucket is NaN
+        a = start + np.argmax(np.where(np.isnan(area), -1.0, area))
+        selected[i + 1] = a
+
+    return selected
 
 
 def merge_portfolio(portfolio: List[Stock]) -> pd.DataFrame:
     """ Merges all stocks in portfolio into one DataFrame"""
-    daily_average_dfs = [] # array of DataFrames, each holding average value of each stock for a period of days
-    for stock in portfolio:
-        df = stock.data.copy().fillna(method="ffill")
-        # get mean for each day
-        df = df.groupby([df["time"].dt.date]).mean() * stock.holding
-        df["book_cost"] = stock.book_cost * 100.0
-        # if stock does not have recorded value for this day, set book cost to 0
-        df.loc[np.isnan(df["value"]), "book_cost"] = 0
-        daily_average_dfs.append(df)
-
-    # combine dataframes, and add actual change and percentage change columns
-    rep = reduce(lambda a, b: a.add(b, fill_value=0), daily_average_dfs)
-    rep["actual_change"] = rep["value"] - rep["book_cost"]
-    rep["percent_change"] = rep["actual_change"] * 100 / rep["book_cost"]
+    # lay the daily values of each holding out as rows of one (n_stocks, n_days) array,
+    # over every day that any stock has data for
+    all_days = np.unique(np.concatenate([stock.daily.index.values for stock in portfolio]))
+    values = np.full((len(portfolio), all_days.size), np.nan)
+    for i, stock in enumerate(portfolio):
+        values[i, np.searchsorted(all_days, stock.daily.index.values)] = stock.daily.to_numpy()
+
+    book_costs = np.array([stock.book_cost * 100.0 for stock in portfolio])
+
+    # if stock does not have recorded value for a day, it adds nothing to the value or book cost for that day
+    held = ~np.isnan(values)
+    total_value = np.where(held, values, 0.0).sum(axis=0)
+    total_value[~held.any(axis=0)] = np.nan
+    total_book_cost = (held * book_costs[:, None]).sum(axis=0)
+
+    # work out actual change and percentage change, and combine everything into one dataframe
+    actual_change = total_value - total_book_cost
+    # with no book cost the percentage change is undefined, so make it NaN rather than inf
+    percent_change = actual_change * 100.0 / np.where(total_book_cost == 0, np.nan, total_book_cost)
+
+    # totals in pence need float64 to stay exact to the penny, but percentages are fine as float32
+    return pd.DataFrame(
+        {
+            "value": total_value,
+            "book_cost": total_book_cost,
+            "actual_change": actual_change,
+            "percent_change": percent_change.astype(np.float32),
+        },
+        index=all_days,
+    )
 
-    return rep
+
+def load_portfolio_state() -> Tuple[List[Stock], pd.DataFrame]:
+    """Returns the portfolio and the merged portfolio DataFrame. In debug mode, both are also pickled so the werkzeug
+    reloader's second import doesn't fetch and merge everything again. The pickle is only reused for a short time,
+    and only while the portfolio, config and this file are unchanged"""
+    if not config_data["DEBUG"]:
+        portfolio = load_portfolio()
+        return portfolio, merge_portfolio(portfolio)
+
+    with open(PORTFOLIO_FILE, "rb") as f:
+        key = hashlib.sha256(
+            f.read()
+            + str(os.stat(__file__).st_mtime_ns).encode()
+            + str(os.stat(CONFIG_FILE).st_mtime_ns).encode()
+        ).hexdigest()
+    try:
+        with open(STATE_FILE, "rb") as f:
+            saved_key, saved_at, state = pickle.load(f)
+        if saved_key == key and time.time() - saved_at < STATE_TTL:
+            return state
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        # a stale or corrupt pickle shouldn't stop the app starting, so rebuild it
+        print(f"Loading saved state has failed. Error message: \n{e}")
+
+    portfolio = load_portfolio()
+    state = (portfolio, merge_portfolio(portfolio))
+    with open(f"{STATE_FILE}.tmp", "wb") as f:
+        pickle.dump((key, time.time(), state), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{STATE_FILE}.tmp", STATE_FILE)
+    return state
 
 
 def convert_currency(
-    value: float, date: dt.datetime = dt.date.today(), c_from: str = "USD"
+    value: float, date: dt.datetime = None, c_from: str = "USD"
 ) -> float:
-    """ Converts currency at `date` from `c_from` to global currency"""
-    global CURRENCY_DATA
+    """ Converts currency at `date` (default today) from `c_from` to global currency"""
+    if date is None:
+        date = dt.date.today()
     date_str = date.strftime("%Y-%m-%d")
 
-    try:
-        return value * CURRENCY_DATA[c_from][date]
-    except KeyError:
-        request = requests.get(
-            f"https://api.exchangerate.host/convert?from={c_from}&to={BASE_CURRENCY}&date={date_str}"
-        ).json()["info"]["rate"]
+    with _CURRENCY_LOCK:
+        rate = _currency_rates(c_from).get(date_str)
+    if rate is None:
+        rate = _fetch_fx_rate(c_from, date_str)
+
+        with _CURRENCY_LOCK:
+            _currency_rates(c_from)[date_str] = rate
+            _DIRTY_CURRENCIES.add(c_from)
+    return value * rate
+
+
+def _fx_rates_for_dates(c_from: str, date_strs: np.ndarray) -> pd.Series:
+    """Returns the exchange rates from `c_from` to global currency for each of `date_strs` (YYYY-MM-DD),
+    as a Series indexed by date string. Rates missing from the cache are fetched and stored in CURRENCY_DATA"""
+
+    # only stocks sharing a currency wait for each other, so they don't request the same rates. CURRENCY_DATA itself
+    # is only locked while it is read or updated, not during the downloads
+    with _CURRENCY_LOCK:
+        fetch_lock = _FETCH_LOCKS.setdefault(c_from, threading.Lock())
+
+    with fetch_lock:
+        with _CURRENCY_LOCK:
+            cached_rates = _currency_rates(c_from)
+            missing = [str(date_str) for date_str in dict.fromkeys(date_strs) if date_str not in cached_rates]
+
+        if missing:
+            # get the whole range of missing dates in as few requests as possible
+            fetched = fetch_fx_range(c_from, min(missing), max(missing))
+            missing = [date_str for date_str in missing if date_str not in fetched]
+
+            if missing:
+                # fetch anything the range didn't include concurrently, rather than waiting for each request in turn
+                with ThreadPoolExecutor(max_workers=min(16, len(missing))) as executor:
+                    rates = list(
+                        executor.map(lambda date_str: _fetch_fx_rate(c_from, date_str), missing)
+                    )
+                # rates that aren't available yet aren't cached, so they are requested again next time
+                fetched.update(
+                    (date_str, rate) for date_str, rate in zip(missing, rates) if rate is not None
+                )
+
+            with _CURRENCY_LOCK:
+                cached_rates.update(fetched)
+                _DIRTY_CURRENCIES.add(c_from)
+
+    with _CURRENCY_LOCK:
+        return pd.Series(
+            [cached_rates.get(date_str, np.nan) for date_str in date_strs],
+            index=date_strs,
+            dtype=np.float64,
+        )
+
 
-        CURRENCY_DATA[c_from][date_str] = request
-        with open(CURRENCY_CACHE_FILE, "w") as f:
-            json.dump(CURRENCY_DATA, f)
-        return value * request
+def _currency_rates(c_from: str) -> dict:
+    """Returns the cached rates from `c_from` to global currency, reading them from the currency's cache file
+    the first time. Must be called while holding _CURRENCY_LOCK"""
+    if c_from not in CURRENCY_DATA:
+        try:
+            with open(os.path.join(CURRENCY_CACHE_FOLDER, f"{c_from}.json"), "rb") as f:
+                CURRENCY_DATA[c_from] = json_loads(f.read())
+        except FileNotFoundError:
+            CURRENCY_DATA[c_from] = {}
+    return CURRENCY_DATA[c_from]
+
+
+def fetch_fx_range(c_from: str, start: str, end: str) -> dict:
+    """Gets the exchange rates from `c_from` to global currency for every day from `start` to `end` (YYYY-MM-DD)
+    from exchangerate.host. Returns a dict of date string to rate"""
+    rates = {}
+    range_start = dt.date.fromisoformat(start)
+    while range_start <= dt.date.fromisoformat(end):
+        # the timeseries endpoint returns at most a year of rates per request
+        range_end = min(range_start + dt.timedelta(days=365), dt.date.fromisoformat(end))
+        response = _SESSION.get(
+            f"https://api.exchangerate.host/timeseries?base={c_from}&symbols={BASE_CURRENCY}"
+            f"&start_date={range_start}&end_date={range_end}",
+            timeout=10,
+        ).json()
+
+        for date_str, day_rates in response.get("rates", {}).items():
+            if day_rates.get(BASE_CURRENCY) is not None:
+                rates[date_str] = day_rates[BASE_CURRENCY]
+        range_start = range_end + dt.timedelta(days=1)
+
+    return rates
+
+
+def _fetch_fx_rate(c_from: str, date_str: str) -> float:
+    """Gets the exchange rate from `c_from` to global currency on `date_str` (YYYY-MM-DD) from exchangerate.host"""
+    return _SESSION.get(
+        f"https://api.exchangerate.host/convert?from={c_from}&to={BASE_CURRENCY}&date={date_str}",
+        timeout=10,
+    ).json()["info"]["rate"]
+
+
+def flush_currency_cache():
+    """Writes the cache file of every currency whose rates have changed since they were last written"""
+    with _CURRENCY_LOCK:
+        if _DIRTY_CURRENCIES:
+            os.makedirs(CURRENCY_CACHE_FOLDER, exist_ok=True)
+        for c_from in _DIRTY_CURRENCIES:
+            path = os.path.join(CURRENCY_CACHE_FOLDER, f"{c_from}.json")
+            # write to a temporary file first, so the cache is never left half written
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(json_dumps(CURRENCY_DATA[c_from]))
+            os.replace(f"{path}.tmp", path)
+        _DIRTY_CURRENCIES.clear()
+
+
+atexit.register(flush_currency_cache)
 
 
 def get_current_price(ticker: str) -> np.float64:
@@ -278,15 +719,18 @@ def get_current_price(ticker: str) -> np.float64:
 
 def parse_date(date_string: str) -> dt.datetime:
     """parses date from YYYY-MM-DD to datetime object.
-    Returns current date if date_string is empty"""
+    Returns current date if date_string is empty, and dates that are already parsed unchanged"""
     if not date_string:
         return dt.date.today()
-    return dt.datetime.strptime(date_string, "%Y-%m-%d")
+    if isinstance(date_string, dt.date):
+        return date_string
+    # slicing the fields out directly is much faster than strptime
+    return dt.datetime(int(date_string[:4]), int(date_string[5:7]), int(date_string[8:10]))
 
 
 def add_new_stock_to_file(new_data: tuple):
-    with open(PORTFOLIO_FILE, "r") as f:
-        portfolio = json.load(f)
+    with open(PORTFOLIO_FILE, "rb") as f:
+        portfolio = json_loads(f.read())
 
     new_data = list(new_data)
     new_data[5:9] = [int(i) for i in new_data[5:9]]